@@ -3,10 +3,17 @@
 from scrapy import Request
 
 
+SCREENSHOT_FORMATS = ('png', 'jpeg', 'webp')
+SCROLL_BOTTOM_KEYS = ('selector', 'max_scrolls', 'timeout')
+
+
 class SeleniumRequest(Request):
     """Scrapy ``Request`` subclass providing additional arguments"""
 
-    def __init__(self, wait_time=None, wait_until=None, screenshot=False, script=None, scroll_bottom=False, always_restart=False, *args, **kwargs):
+    __slots__ = ('wait_time', 'wait_until', 'screenshot', 'script', 'scroll_bottom',
+                 'always_restart', 'screenshot_format', 'wait_stable_ms')
+
+    def __init__(self, wait_time=None, wait_until=None, screenshot=False, script=None, scroll_bottom=False, always_restart=False, screenshot_format='png', wait_stable_ms=None, *args, **kwargs):
         """Initialize a new selenium request
 
         Parameters
@@ -22,17 +29,46 @@ class SeleniumRequest(Request):
             If a string is given, the screenshot will be saved to the given path.
         script: str
             JavaScript code to execute.
-        scroll_bottom: bool
+        scroll_bottom: bool or dict
             If True, the page will be scrolled to the bottom before returning the response.
+            If a dict is given, the page will be scrolled while new content is rendered
+            before the sentinel element matching its "selector" key. The optional
+            "max_scrolls" and "timeout" keys limit the number of scrolls and the seconds
+            to wait for new content.
         always_restart: bool
-            If True, the driver will be restarted for each request.
+            If True, the request will be loaded with a clean browser state. Locally
+            started chromium drivers load it in a new browser context, with its own
+            cookies, storage and cache, and close their other windows. Other drivers
+            are restarted.
+        screenshot_format: str
+            The image format of the screenshot, one of "png", "jpeg" or "webp".
+            Formats other than "png" are only supported by locally started chromium
+            drivers, other drivers (including remote ones) fail the request.
+        wait_stable_ms: int
+            If given, the response will be returned once the DOM had no mutation for this
+            number of milliseconds, or after "wait_time" seconds if set, and at most after
+            20 seconds.
         """
 
+        if screenshot_format not in SCREENSHOT_FORMATS:
+            raise ValueError(f'screenshot_format must be one of {SCREENSHOT_FORMATS}, '
+                             f'got {screenshot_format!r}')
+
+        if isinstance(scroll_bottom, dict):
+            if 'selector' not in scroll_bottom:
+                raise ValueError('scroll_bottom must have a "selector" key')
+            unknown_keys = set(scroll_bottom) - set(SCROLL_BOTTOM_KEYS)
+            if unknown_keys:
+                raise ValueError(f'scroll_bottom keys must be among {SCROLL_BOTTOM_KEYS}, '
+                                 f'got {sorted(unknown_keys)}')
+
         self.wait_time = wait_time
         self.wait_until = wait_until
         self.screenshot = screenshot
         self.script = script
         self.scroll_bottom = scroll_bottom
         self.always_restart = always_restart
+        self.screenshot_format = screenshot_format
+        self.wait_stable_ms = wait_stable_ms
 
         super().__init__(*args, **kwargs)
@@ -1,20 +1,151 @@
 """This module contains the ``SeleniumMiddleware`` scrapy middleware"""
 
+import base64
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from importlib import import_module
 from queue import Queue
 from shutil import which
-from threading import Lock
 
 from scrapy import signals
-from scrapy.exceptions import NotConfigured
+from scrapy.exceptions import IgnoreRequest, NotConfigured, NotSupported
 from scrapy.http import HtmlResponse
+from scrapy.utils.defer import maybe_deferred_to_future
 from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chromium.webdriver import ChromiumDriver
 from selenium.webdriver.support.ui import WebDriverWait
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
 from .http import SeleniumRequest
 
+_DEFAULT_DRIVER_ARGUMENTS = (
+    '--headless=new',
+    '--no-sandbox',
+    '--disable-gpu',
+    '--window-size=1280,1696',
+    '--disable-blink-features',
+    '--disable-blink-features=AutomationControlled',
+    '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+)
+
+# Maximum run time of the asynchronous scripts, below the default 30s script timeout
+_SCRIPT_BUDGET_MS = 20000
+
+# Scroll to the bottom until the height is unchanged for the quiet period in milliseconds,
+# doubling the delay between checks up to 1.5s. Resolves with [settled, lastHeight, quiet]
+# once settled or after the budget in milliseconds, the last two values are passed back
+# to the next call to carry on where it stopped.
+_SCROLL_DOWN_SCRIPT = """
+const [quietMs, budgetMs, previousHeight, previousQuiet, done] = arguments;
+const deadline = Date.now() + budgetMs;
+let lastHeight = previousHeight === null ? document.body.scrollHeight : previousHeight;
+let quiet = previousQuiet;
+(function tick(delay) {
+    window.scrollTo({ top: document.body.scrollHeight });
+    setTimeout(() => {
+        const height = document.body.scrollHeight;
+        if (height !== lastHeight) {
+            lastHeight = height;
+            quiet = 0;
+        } else {
+            quiet += delay;
+            if (quiet >= quietMs) {
+                return done([true, lastHeight, quiet]);
+            }
+        }
+        if (Date.now() >= deadline) {
+            return done([false, lastHeight, quiet]);
+        }
+        tick(Math.min(delay * 2, 1500));
+    }, delay);
+})(100);
+"""
+
+# Scroll to the bottom each time the sentinel element leaves the viewport, i.e. new content
+# was rendered above it. Resolves with [scrolls, settled, quiet]: settled is false if the
+# budget in milliseconds ran out first, quiet is then passed back to the next call to carry
+# on the quiet period where it stopped.
+_SCROLL_TO_SENTINEL_SCRIPT = """
+const [selector, maxScrolls, quietMs, budgetMs, previousQuiet, done] = arguments;
+const sentinel = document.querySelector(selector);
+if (!sentinel) {
+    return done([0, true, previousQuiet]);
+}
+let scrolls = 0, quietTimer = null, quietStart = null;
+const budgetTimer = setTimeout(() => finish(false), budgetMs);
+const observer = new IntersectionObserver(entries => {
+    clearTimeout(quietTimer);
+    const now = Date.now();
+    // The first callback reports the initial state, the quiet period goes on from there
+    quietStart = quietStart === null ? now - previousQuiet : now;
+    if (!entries[entries.length - 1].isIntersecting) {
+        if (scrolls >= maxScrolls) {
+            return finish(true);
+        }
+        scrolls++;
+        window.scrollTo({ top: document.body.scrollHeight });
+    }
+    quietTimer = setTimeout(() => finish(true), quietStart + quietMs - now);
+}, { threshold: 0 });
+function finish(settled) {
+    observer.disconnect();
+    clearTimeout(quietTimer);
+    clearTimeout(budgetTimer);
+    done([scrolls, settled, quietStart === null ? previousQuiet : Date.now() - quietStart]);
+}
+observer.observe(sentinel);
+"""
+
+# Return the serialized document, as chromedriver's page_source does, and the url, or null
+# if the driver is switched to a frame
+_PAGE_CONTENT_SCRIPT = """
+if (window.top !== window.self) {
+    return null;
+}
+return [new XMLSerializer().serializeToString(document), location.href];
+"""
+
+# Resolve once no DOM mutation happened for the given quiet period in milliseconds, or
+# after the given maximum in milliseconds. The observer is disconnected in both cases.
+_WAIT_DOM_STABLE_SCRIPT = """
+const [quietMs, maxMs, done] = arguments;
+let quietTimer = setTimeout(finish, quietMs);
+const maxTimer = setTimeout(finish, maxMs);
+const observer = new MutationObserver(() => {
+    clearTimeout(quietTimer);
+    quietTimer = setTimeout(finish, quietMs);
+});
+function finish() {
+    observer.disconnect();
+    clearTimeout(quietTimer);
+    clearTimeout(maxTimer);
+    done();
+}
+observer.observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+"""
+
+
+@lru_cache(maxsize=None)
+def _resolve_driver_classes(driver_name):
+    """Return the ``WebDriver``, ``Options`` and ``Service`` classes of the given driver"""
+
+    webdriver_base_path = f'selenium.webdriver.{driver_name}'
+
+    driver_klass_module = import_module(f'{webdriver_base_path}.webdriver')
+    driver_klass = getattr(driver_klass_module, 'WebDriver')
+
+    driver_options_module = import_module(f'{webdriver_base_path}.options')
+    driver_options_klass = getattr(driver_options_module, 'Options')
+
+    service_module = import_module(f'{webdriver_base_path}.service')
+    service_klass = getattr(service_module, 'Service')
+
+    return driver_klass, driver_options_klass, service_klass
+
 
 class SeleniumMiddleware:
     """Scrapy middleware handling the requests using selenium"""
@@ -40,24 +171,48 @@ class SeleniumMiddleware:
         """
 
         self.driver_queue = Queue(maxsize=driver_count)
-        self.lock = Lock()
-
-        for _ in range(driver_count):
-            driver = self._create_driver(driver_name, driver_executable_path,
-                                         browser_executable_path, command_executor, driver_arguments)
+        self._driver_settings = (driver_name, driver_executable_path,
+                                 browser_executable_path, command_executor, driver_arguments)
+
+        # Start the browsers concurrently, a cold start takes seconds
+        with ThreadPoolExecutor(max_workers=driver_count) as executor:
+            futures = [
+                executor.submit(self._create_driver, *self._driver_settings)
+                for _ in range(driver_count)
+            ]
+
+        drivers = [future.result() for future in futures if future.exception() is None]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            # Do not leave the browsers that did start running
+            for driver in drivers:
+                driver.quit()
+            raise errors[0]
+
+        self.drivers = drivers
+        for driver in drivers:
             self.driver_queue.put(driver)
 
+        # Each thread keeps the first driver it takes from the queue, so the pool must not
+        # have more threads than drivers
+        self._tls = threading.local()
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=driver_count,
+                                     name='SeleniumMiddleware')
+        self.threadpool.start()
+        self.closing = False
+
+        # Imported here to not install the default reactor before scrapy installs its own
+        from twisted.internet import reactor
+
+        # The pool threads are not daemonic, stop them even if the spider is never closed
+        self._shutdown_trigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._stop_threadpool)
+
     def _create_driver(self, driver_name, driver_executable_path,
                        browser_executable_path, command_executor, driver_arguments):
         """Create a new selenium webdriver instance"""
 
-        webdriver_base_path = f'selenium.webdriver.{driver_name}'
-
-        driver_klass_module = import_module(f'{webdriver_base_path}.webdriver')
-        driver_klass = getattr(driver_klass_module, 'WebDriver')
-
-        driver_options_module = import_module(f'{webdriver_base_path}.options')
-        driver_options_klass = getattr(driver_options_module, 'Options')
+        driver_klass, driver_options_klass, service_klass = _resolve_driver_classes(driver_name)
 
         driver_options = driver_options_klass()
 
@@ -72,8 +227,6 @@ class SeleniumMiddleware:
                                       options=driver_options)
         # locally installed driver
         elif driver_executable_path is not None:
-            service_module = import_module(f'{webdriver_base_path}.service')
-            service_klass = getattr(service_module, 'Service')
             service_kwargs = {
                 'executable_path': driver_executable_path,
             }
@@ -91,19 +244,11 @@ class SeleniumMiddleware:
         """Initialize the middleware with the crawler settings"""
 
         driver_name = crawler.settings.get('SELENIUM_DRIVER_NAME', 'chrome')
-        driver_executable_path = crawler.settings.get('SELENIUM_DRIVER_EXECUTABLE_PATH', which('chromedriver'))
+        driver_executable_path = crawler.settings.get('SELENIUM_DRIVER_EXECUTABLE_PATH') or which('chromedriver')
         browser_executable_path = crawler.settings.get('SELENIUM_BROWSER_EXECUTABLE_PATH')
         command_executor = crawler.settings.get('SELENIUM_COMMAND_EXECUTOR')
-        driver_arguments = crawler.settings.get('SELENIUM_DRIVER_ARGUMENTS', [
-            '--headless=new',
-            '--no-sandbox',
-            '--disable-gpu',
-            '--window-size=1280,1696',
-            '--disable-blink-features',
-            '--disable-blink-features=AutomationControlled',
-            '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        ])
-        driver_count = crawler.settings.get('SELENIUM_DRIVER_COUNT', 1)
+        driver_arguments = crawler.settings.get('SELENIUM_DRIVER_ARGUMENTS', _DEFAULT_DRIVER_ARGUMENTS)
+        driver_count = crawler.settings.getint('SELENIUM_DRIVER_COUNT', 1)
 
         if driver_name is None:
             raise NotConfigured('SELENIUM_DRIVER_NAME must be set')
@@ -112,6 +257,9 @@ class SeleniumMiddleware:
             raise NotConfigured('Either SELENIUM_DRIVER_EXECUTABLE_PATH '
                                 'or SELENIUM_COMMAND_EXECUTOR must be set')
 
+        if driver_count < 1:
+            raise NotConfigured('SELENIUM_DRIVER_COUNT must be at least 1')
+
         middleware = cls(
             driver_name=driver_name,
             driver_executable_path=driver_executable_path,
@@ -127,63 +275,223 @@ class SeleniumMiddleware:
 
     @staticmethod
     def scroll_down_until_no_more_content(driver, timeout=10):
-        last_height = driver.execute_script("return document.body.scrollHeight")
+        """Scroll to the bottom of the page until it did not grow for ``timeout`` seconds
+
+        The scrolling and the height checks run inside the browser, with an exponential
+        back-off between checks.
+        """
 
+        last_height, quiet = None, 0
         while True:
-            driver.execute_script("window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' });")
+            try:
+                settled, last_height, quiet = driver.execute_async_script(
+                    _SCROLL_DOWN_SCRIPT, timeout * 1000, _SCRIPT_BUDGET_MS, last_height, quiet
+                )
+            except TimeoutException:
+                break
+
+            if settled:
+                break
+
+    @staticmethod
+    def scroll_down_to_sentinel(driver, selector, max_scrolls=20, timeout=10):
+        """Scroll to the bottom of the page while new content pushes the sentinel away
+
+        The sentinel is the element matching ``selector`` at the end of the content, like a
+        "load more" block. The browser reports its visibility through an
+        ``IntersectionObserver``, so nothing is polled. Scrolling stops after ``max_scrolls``
+        scrolls, when the sentinel is missing, or when it stayed visible for ``timeout``
+        seconds.
+        """
 
+        remaining_scrolls, quiet = max_scrolls, 0
+        while remaining_scrolls > 0:
             try:
-                WebDriverWait(driver, timeout).until(
-                    lambda d: d.execute_script("return document.body.scrollHeight") > last_height
+                scrolls, settled, quiet = driver.execute_async_script(
+                    _SCROLL_TO_SENTINEL_SCRIPT, selector, remaining_scrolls, timeout * 1000,
+                    _SCRIPT_BUDGET_MS, quiet
                 )
             except TimeoutException:
                 break
 
-            new_height = driver.execute_script("return document.body.scrollHeight")
-            if new_height == last_height:
+            remaining_scrolls -= scrolls
+            if settled:
                 break
-            last_height = new_height
+
+    @staticmethod
+    def _add_cookies(driver, request):
+        """Add the request cookies to the driver"""
+
+        if not request.cookies:
+            return
+
+        if isinstance(driver, ChromiumDriver):
+            cookies = [
+                {
+                    'name': cookie_name,
+                    'value': cookie_value,
+                    'url': request.url
+                }
+                for cookie_name, cookie_value in request.cookies.items()
+            ]
+            driver.execute_cdp_cmd('Network.setCookies', {'cookies': cookies})
+        else:
+            for cookie_name, cookie_value in request.cookies.items():
+                driver.add_cookie(
+                    {
+                        'name': cookie_name,
+                        'value': cookie_value
+                    }
+                )
+
+    @staticmethod
+    def _take_screenshot(driver, screenshot_format='png'):
+        """Return the binary data of a screenshot of the visible part of the page"""
+
+        if isinstance(driver, ChromiumDriver):
+            screenshot = driver.execute_cdp_cmd('Page.captureScreenshot', {
+                'format': screenshot_format,
+                'captureBeyondViewport': False
+            })
+            return base64.b64decode(screenshot['data'])
+
+        if screenshot_format != 'png':
+            raise NotSupported(f'Screenshot format {screenshot_format} is not supported by '
+                               f'{driver.__class__.__module__}')
+        return driver.get_screenshot_as_png()
+
+    @staticmethod
+    def _get_page_content(driver):
+        """Return the url and the html of the current page"""
+
+        if isinstance(driver, ChromiumDriver):
+            content = driver.execute_script(_PAGE_CONTENT_SCRIPT)
+            if content is not None:
+                html, url = content
+                return url, html
+
+        return driver.current_url, driver.page_source
+
+    @staticmethod
+    def _is_healthy(driver):
+        """Return whether the driver still has an open browser window"""
+
+        try:
+            return bool(driver.window_handles)
+        except WebDriverException:
+            return False
+
+    def _refresh_driver(self, driver):
+        """Return the driver with a clean state, restarting it only if needed"""
+
+        if isinstance(driver, ChromiumDriver) and self._is_healthy(driver):
+            try:
+                return self._isolate_driver(driver)
+            except WebDriverException as e:
+                logging.warning(f"Failed to clear the driver state, restarting it: {e}")
+
+        return self._restart_driver(driver)
+
+    def _isolate_driver(self, driver):
+        """Move the chromium driver to a new browser context, like a new incognito window
+
+        The cookies, storage and cache of a browser context are not shared with the other
+        ones, whatever the origins or frames that filled them. The other windows and the
+        browser context of the previous refresh are closed.
+        """
+
+        handles = driver.window_handles
+        context_id = driver.execute_cdp_cmd('Target.createBrowserContext', {})['browserContextId']
+        target_id = driver.execute_cdp_cmd('Target.createTarget', {
+            'url': 'about:blank',
+            'browserContextId': context_id,
+        })['targetId']
+
+        # The window handles of chromedriver are the DevTools target ids
+        driver.switch_to.window(target_id)
+        for handle in handles:
+            driver.execute_cdp_cmd('Target.closeTarget', {'targetId': handle})
+
+        previous_context_id = getattr(self._tls, 'browser_context_id', None)
+        self._tls.browser_context_id = context_id
+        if previous_context_id is not None:
+            driver.execute_cdp_cmd('Target.disposeBrowserContext', {'browserContextId': previous_context_id})
+
+        return driver
 
     def _restart_driver(self, driver):
-        old_driver = driver
-        driver_options = driver.options
+        """Replace the driver with a newly started one"""
+
+        new_driver = self._create_driver(*self._driver_settings)
+        self._tls.browser_context_id = None
+
+        # The old driver may be broken already, it must not prevent using the new one
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.warning(f"Failed to quit the restarted driver: {e}")
 
-        # locally installed driver
-        if driver.service:
-            service = driver.service
-            driver_kwargs = {
-                'service': service,
-                'options': driver_options
-            }
-            new_driver = driver.__class__(**driver_kwargs)
-        # remote driver
-        elif driver.command_executor:
-            new_driver = webdriver.Remote(command_executor=driver.command_executor._url,
-                                          options=driver_options)
-        old_driver.quit()
         return new_driver
 
-    def process_request(self, request, spider):
-        """Process a request using the selenium driver if applicable"""
+    async def process_request(self, request, spider):
+        """Process a request using the selenium driver if applicable
+
+        The selenium calls are blocking, so they run in the middleware thread pool while
+        the response is awaited. This lets up to ``SELENIUM_DRIVER_COUNT`` requests use the
+        pool concurrently, as long as ``CONCURRENT_REQUESTS`` is at least as large.
+        """
 
         if not isinstance(request, SeleniumRequest):
             return None
 
-        with self.lock:
-            driver = self.driver_queue.get()
+        # Imported here to not install the default reactor before scrapy installs its own
+        from twisted.internet import reactor
 
-        if request.always_restart:
-            driver = self._restart_driver(driver)
+        return await maybe_deferred_to_future(
+            deferToThreadPool(reactor, self.threadpool, self._run_in_driver, request)
+        )
 
-        driver.get(request.url)
+    def _run_in_driver(self, request):
+        """Process the request with the driver bound to the current thread
 
-        for cookie_name, cookie_value in request.cookies.items():
-            driver.add_cookie(
-                {
-                    'name': cookie_name,
-                    'value': cookie_value
-                }
-            )
+        A thread takes a driver from the queue the first time it processes a request and
+        keeps it for its lifetime. The driver exposed in the request "meta" may already be
+        processing another request when the callback runs, it must not be driven from there.
+        """
+
+        if self.closing:
+            raise IgnoreRequest(f'Spider closed before {request.url} was processed')
+
+        driver = getattr(self._tls, 'driver', None)
+        if driver is None:
+            driver = self._tls.driver = self.driver_queue.get()
+
+        if request.always_restart:
+            new_driver = self._refresh_driver(driver)
+            self.drivers[self.drivers.index(driver)] = new_driver
+            driver = self._tls.driver = new_driver
+
+        return self._process_with_driver(driver, request)
+
+    def _process_with_driver(self, driver, request):
+        """Load the request in the given driver and build the response"""
+
+        # Chromium based drivers can set the cookies before the navigation, so they are
+        # already sent with the page request. Other drivers need the page to be loaded.
+        if isinstance(driver, ChromiumDriver):
+            self._add_cookies(driver, request)
+            driver.get(request.url)
+        else:
+            driver.get(request.url)
+            self._add_cookies(driver, request)
+
+        if request.wait_stable_ms:
+            # Finish before the script timeout, which would leave the observer running
+            max_ms = min(request.wait_time * 1000, _SCRIPT_BUDGET_MS) if request.wait_time else _SCRIPT_BUDGET_MS
+            try:
+                driver.execute_async_script(_WAIT_DOM_STABLE_SCRIPT, request.wait_stable_ms, max_ms)
+            except TimeoutException:
+                pass
 
         if request.wait_until:
             try:
@@ -194,9 +502,9 @@ class SeleniumMiddleware:
                 pass
 
         if isinstance(request.screenshot, bool) and request.screenshot:
-            request.meta['screenshot'] = driver.get_screenshot_as_png()
+            request.meta['screenshot'] = self._take_screenshot(driver, request.screenshot_format)
         elif isinstance(request.screenshot, str):
-            screenshot_data = driver.get_screenshot_as_png()
+            screenshot_data = self._take_screenshot(driver, request.screenshot_format)
             with open(request.screenshot, 'wb') as f:
                 f.write(screenshot_data)
             request.meta['screenshot'] = request.screenshot
@@ -207,30 +515,44 @@ class SeleniumMiddleware:
             except Exception as e:
                 logging.error(f"JavaScript execution error: {e}")
 
-        if request.scroll_bottom:
+        if isinstance(request.scroll_bottom, dict):
+            SeleniumMiddleware.scroll_down_to_sentinel(driver, **request.scroll_bottom)
+        elif request.scroll_bottom:
             SeleniumMiddleware.scroll_down_until_no_more_content(driver)
 
-        body = str.encode(driver.page_source)
+        url, html = self._get_page_content(driver)
 
         # Expose the driver via the "meta" attribute
         request.meta.update({'driver': driver})
 
-        response = HtmlResponse(
-            driver.current_url,
-            body=body,
+        return HtmlResponse(
+            url,
+            body=html.encode('utf-8', 'replace'),
             encoding='utf-8',
             request=request
         )
 
-        with self.lock:
-            self.driver_queue.put(driver)
+    def _stop_threadpool(self):
+        """Drop the queued requests and wait for the running ones, only once"""
 
-        return response
+        self.closing = True
+        if not self.threadpool.joined:
+            self.threadpool.stop()
 
     def spider_closed(self):
         """Shutdown all drivers when spider is closed"""
 
-        while not self.driver_queue.empty():
-            driver = self.driver_queue.get()
-            driver.quit()
+        # The requests still queued are dropped, the running ones are waited for before
+        # quitting their drivers
+        from twisted.internet import reactor
+
+        try:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        except ValueError:
+            # Already fired by the reactor shutdown
+            pass
+        self._stop_threadpool()
+
+        with ThreadPoolExecutor(max_workers=len(self.drivers)) as executor:
+            list(executor.map(lambda driver: driver.quit(), self.drivers))
 
@@ -22,7 +22,7 @@ VERSION = '1.0.1rc6'
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'Scrapy >= 2.5.0',
+    'Scrapy >= 2.6.0',
     'selenium >= 4.0.0',
 ]
 
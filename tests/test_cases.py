@@ -1,9 +1,9 @@
 """This module contains the base test cases for the ``scrapy_selenium4`` package"""
 
 from shutil import which
-from unittest import TestCase
 
 import scrapy
+from twisted.trial.unittest import TestCase
 
 
 class BaseScrapySeleniumTestCase(TestCase):
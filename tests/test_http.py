@@ -0,0 +1,28 @@
+"""This module contains the test cases for the ``SeleniumRequest`` of the ``scrapy_selenium4`` package"""
+
+from twisted.trial.unittest import TestCase
+
+from scrapy_selenium4.http import SeleniumRequest
+
+
+class SeleniumRequestTestCase(TestCase):
+    """Test case for the ``SeleniumRequest`` request"""
+
+    def test_init_should_accept_a_scroll_bottom_dict_with_a_selector(self):
+        """Test that the ``scroll_bottom`` dict only needs a ``selector`` key"""
+
+        request = SeleniumRequest(url='http://www.python.org', scroll_bottom={'selector': '#more'})
+
+        self.assertEqual(request.scroll_bottom, {'selector': '#more'})
+
+    def test_init_should_raise_value_error_if_scroll_bottom_has_no_selector(self):
+        """Test that a ``scroll_bottom`` dict without ``selector`` is refused"""
+
+        with self.assertRaises(ValueError):
+            SeleniumRequest(url='http://www.python.org', scroll_bottom={'max_scrolls': 5})
+
+    def test_init_should_raise_value_error_if_scroll_bottom_has_unknown_keys(self):
+        """Test that a ``scroll_bottom`` dict with unknown keys is refused"""
+
+        with self.assertRaises(ValueError):
+            SeleniumRequest(url='http://www.python.org', scroll_bottom={'selector': '#more', 'timout': 5})
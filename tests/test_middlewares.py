@@ -1,9 +1,17 @@
 """This module contains the test cases for the middlewares of the ``scrapy_selenium4`` package"""
 
-from unittest.mock import patch
+import threading
+from inspect import iscoroutine
+from unittest.mock import MagicMock, PropertyMock, call, patch
+from urllib.parse import quote
 
 from scrapy import Request
 from scrapy.crawler import Crawler
+from scrapy.exceptions import IgnoreRequest, NotConfigured, NotSupported
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chromium.webdriver import ChromiumDriver
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
 
 from scrapy_selenium4.http import SeleniumRequest
 from scrapy_selenium4.middlewares import SeleniumMiddleware
@@ -33,7 +41,7 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
 
         super().tearDownClass()
 
-        cls.selenium_middleware.driver.quit()
+        cls.selenium_middleware.spider_closed()
 
     def test_from_crawler_method_should_initialize_the_driver(self):
         """Test that the ``from_crawler`` method should initialize the selenium driver"""
@@ -46,13 +54,14 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
         selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
 
         # The driver must be initialized
-        self.assertIsNotNone(selenium_middleware.driver)
+        driver = selenium_middleware.drivers[0]
+        self.assertIsNotNone(driver)
 
         # We can now use the driver
-        selenium_middleware.driver.get('http://www.python.org')
-        self.assertIn('Python', selenium_middleware.driver.title)
+        driver.get('http://www.python.org')
+        self.assertIn('Python', driver.title)
 
-        selenium_middleware.driver.close()
+        selenium_middleware.spider_closed()
 
     def test_spider_closed_should_close_the_driver(self):
         """Test that the ``spider_closed`` method should close the driver"""
@@ -64,37 +73,46 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
 
         selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
 
-        with patch.object(selenium_middleware.driver, 'quit') as mocked_quit:
+        with patch.object(selenium_middleware.drivers[0], 'quit') as mocked_quit:
             selenium_middleware.spider_closed()
 
         mocked_quit.assert_called_once()
 
+    @defer.inlineCallbacks
     def test_process_request_should_return_none_if_not_selenium_request(self):
         """Test that the ``process_request`` should return none if not selenium request"""
 
         scrapy_request = Request(url='http://not-an-url')
 
-        self.assertIsNone(
+        response = yield defer.ensureDeferred(
             self.selenium_middleware.process_request(
                 request=scrapy_request,
                 spider=None
             )
         )
 
+        self.assertIsNone(response)
+
+    @defer.inlineCallbacks
     def test_process_request_should_return_a_response_if_selenium_request(self):
         """Test that the ``process_request`` should return a response if selenium request"""
 
         selenium_request = SeleniumRequest(url='http://www.python.org')
 
-        html_response = self.selenium_middleware.process_request(
+        coroutine = self.selenium_middleware.process_request(
             request=selenium_request,
             spider=None
         )
 
+        # The response is processed in a thread and awaited
+        self.assertTrue(iscoroutine(coroutine))
+
+        html_response = yield defer.ensureDeferred(coroutine)
+
         # We have access to the driver on the response via the "meta"
         self.assertEqual(
             html_response.meta['driver'],
-            self.selenium_middleware.driver
+            self.selenium_middleware.drivers[0]
         )
 
         # We also have access to the "selector" attribute on the response
@@ -103,6 +121,7 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             'Welcome to Python.org'
         )
 
+    @defer.inlineCallbacks
     def test_process_request_should_return_a_screenshot_if_screenshot_option(self):
         """Test that the ``process_request`` should return a response with a screenshot"""
 
@@ -111,13 +130,100 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             screenshot=True
         )
 
-        html_response = self.selenium_middleware.process_request(
+        html_response = yield defer.ensureDeferred(self.selenium_middleware.process_request(
             request=selenium_request,
             spider=None
-        )
+        ))
 
         self.assertIsNotNone(html_response.meta['screenshot'])
 
+    def test_process_request_should_fail_if_screenshot_format_not_supported(self):
+        """Test that the ``process_request`` should fail if the driver cannot take the screenshot format"""
+
+        selenium_request = SeleniumRequest(
+            url='http://www.python.org',
+            screenshot=True,
+            screenshot_format='jpeg'
+        )
+
+        return self.assertFailure(
+            defer.ensureDeferred(self.selenium_middleware.process_request(
+                request=selenium_request,
+                spider=None
+            )),
+            NotSupported
+        )
+
+    @defer.inlineCallbacks
+    def test_process_request_should_wait_for_dom_stable_if_wait_stable_ms_option(self):
+        """Test that the ``process_request`` should return a response once the DOM is stable"""
+
+        # The page keeps adding paragraphs for 900ms after it is loaded
+        page = (
+            '<html><body><script>'
+            'let count = 0;'
+            'const timer = setInterval(() => {'
+            'document.body.insertAdjacentHTML("beforeend", "<p class=late>late</p>");'
+            'if (++count === 3) clearInterval(timer);'
+            '}, 300);'
+            '</script></body></html>'
+        )
+
+        selenium_request = SeleniumRequest(
+            url=f'data:text/html,{quote(page)}',
+            wait_time=10,
+            wait_stable_ms=500
+        )
+
+        html_response = yield defer.ensureDeferred(self.selenium_middleware.process_request(
+            request=selenium_request,
+            spider=None
+        ))
+
+        self.assertEqual(
+            len(html_response.selector.xpath('//p[@class="late"]')),
+            3
+        )
+
+    @defer.inlineCallbacks
+    def test_process_request_should_scroll_to_sentinel_if_scroll_bottom_option_is_a_dict(self):
+        """Test that the ``process_request`` should scroll while content is loaded before the sentinel"""
+
+        # Each time the sentinel becomes visible, a screen high item is added before it,
+        # up to 3 items
+        script = (
+            'const sentinel = document.createElement("div");'
+            'sentinel.id = "sentinel";'
+            'document.body.appendChild(sentinel);'
+            'let loaded = 0;'
+            'new IntersectionObserver(entries => {'
+            '    if (entries[0].isIntersecting && loaded < 3) {'
+            '        loaded++;'
+            '        const item = document.createElement("div");'
+            '        item.className = "item";'
+            '        item.style.height = "2000px";'
+            '        document.body.insertBefore(item, sentinel);'
+            '    }'
+            '}).observe(sentinel);'
+        )
+
+        selenium_request = SeleniumRequest(
+            url='http://www.python.org',
+            script=script,
+            scroll_bottom={'selector': '#sentinel', 'max_scrolls': 10, 'timeout': 1}
+        )
+
+        html_response = yield defer.ensureDeferred(self.selenium_middleware.process_request(
+            request=selenium_request,
+            spider=None
+        ))
+
+        self.assertEqual(
+            len(html_response.selector.xpath('//div[@class="item"]')),
+            3
+        )
+
+    @defer.inlineCallbacks
     def test_process_request_should_execute_script_if_script_option(self):
         """Test that the ``process_request`` should execute the script and return a response"""
 
@@ -126,12 +232,194 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             script='document.title = "scrapy_selenium4";'
         )
 
-        html_response = self.selenium_middleware.process_request(
+        html_response = yield defer.ensureDeferred(self.selenium_middleware.process_request(
             request=selenium_request,
             spider=None
-        )
+        ))
 
         self.assertEqual(
             html_response.selector.xpath('//title/text()').extract_first(),
             'scrapy_selenium4'
         )
+
+
+class SeleniumMiddlewareMockedDriverTestCase(TestCase):
+    """Test case for the ``SeleniumMiddleware`` middleware with mocked chromium drivers"""
+
+    @staticmethod
+    def create_driver(*args):
+        """Return a mocked chromium driver"""
+
+        driver = MagicMock(spec=ChromiumDriver)
+        driver.window_handles = ['main']
+        driver.execute_script.return_value = ['<html><title>mocked</title></html>', 'http://www.python.org/']
+        return driver
+
+    def create_middleware(self, driver_count=1):
+        """Return a middleware using mocked drivers, closed at the end of the test"""
+
+        with patch.object(SeleniumMiddleware, '_create_driver', side_effect=self.create_driver):
+            middleware = SeleniumMiddleware(
+                driver_name='chrome',
+                driver_executable_path='chromedriver',
+                browser_executable_path=None,
+                command_executor=None,
+                driver_arguments=[],
+                driver_count=driver_count
+            )
+
+        self.addCleanup(middleware.spider_closed)
+
+        return middleware
+
+    def test_init_should_quit_the_started_drivers_if_a_driver_fails_to_start(self):
+        """Test that the ``__init__`` should quit the started drivers if another one fails to start"""
+
+        drivers = [self.create_driver(), self.create_driver()]
+
+        with patch.object(SeleniumMiddleware, '_create_driver',
+                          side_effect=[drivers[0], WebDriverException('failed'), drivers[1]]):
+            with self.assertRaises(WebDriverException):
+                SeleniumMiddleware(
+                    driver_name='chrome',
+                    driver_executable_path='chromedriver',
+                    browser_executable_path=None,
+                    command_executor=None,
+                    driver_arguments=[],
+                    driver_count=3
+                )
+
+        for driver in drivers:
+            driver.quit.assert_called_once()
+
+    def test_from_crawler_should_raise_not_configured_if_driver_count_below_one(self):
+        """Test that the ``from_crawler`` method should refuse a driver count below one"""
+
+        crawler = Crawler(
+            spidercls=BaseScrapySeleniumTestCase.SimpleSpider,
+            settings={
+                'SELENIUM_DRIVER_EXECUTABLE_PATH': 'chromedriver',
+                'SELENIUM_DRIVER_COUNT': 0
+            }
+        )
+
+        with self.assertRaises(NotConfigured):
+            SeleniumMiddleware.from_crawler(crawler)
+
+    def test_reactor_shutdown_should_stop_the_thread_pool(self):
+        """Test that the thread pool is stopped on reactor shutdown if the spider is not closed"""
+
+        middleware = self.create_middleware()
+
+        event, (phase, stop, args, kwargs) = middleware._shutdown_trigger
+        self.assertEqual((event, phase), ('shutdown', 'during'))
+        stop(*args, **kwargs)
+
+        self.assertTrue(middleware.closing)
+        self.assertTrue(middleware.threadpool.joined)
+
+    def test_refresh_driver_should_move_a_chromium_driver_to_a_new_browser_context(self):
+        """Test that the ``_refresh_driver`` isolates a healthy chromium driver without restarting it"""
+
+        middleware = self.create_middleware()
+        driver = middleware.drivers[0]
+        driver.window_handles = ['main', 'popup']
+        driver.execute_cdp_cmd.side_effect = [
+            {'browserContextId': 'context-1'}, {'targetId': 'tab-1'}, {}, {},
+            {'browserContextId': 'context-2'}, {'targetId': 'tab-2'}, {}, {},
+        ]
+
+        self.assertIs(middleware._refresh_driver(driver), driver)
+        driver.window_handles = ['tab-1']
+        self.assertIs(middleware._refresh_driver(driver), driver)
+
+        driver.switch_to.window.assert_has_calls([call('tab-1'), call('tab-2')])
+        self.assertEqual(driver.execute_cdp_cmd.call_args_list, [
+            call('Target.createBrowserContext', {}),
+            call('Target.createTarget', {'url': 'about:blank', 'browserContextId': 'context-1'}),
+            call('Target.closeTarget', {'targetId': 'main'}),
+            call('Target.closeTarget', {'targetId': 'popup'}),
+            call('Target.createBrowserContext', {}),
+            call('Target.createTarget', {'url': 'about:blank', 'browserContextId': 'context-2'}),
+            call('Target.closeTarget', {'targetId': 'tab-1'}),
+            call('Target.disposeBrowserContext', {'browserContextId': 'context-1'}),
+        ])
+        driver.quit.assert_not_called()
+
+    def test_always_restart_should_replace_an_unhealthy_driver(self):
+        """Test that an ``always_restart`` request replaces a broken driver with a newly created one"""
+
+        middleware = self.create_middleware()
+        driver = middleware.drivers[0]
+        type(driver).window_handles = PropertyMock(side_effect=WebDriverException('crashed'))
+        driver.quit.side_effect = WebDriverException('crashed')
+        new_driver = self.create_driver()
+
+        with patch.object(middleware, '_create_driver', return_value=new_driver) as mocked_create_driver:
+            response = middleware._run_in_driver(
+                SeleniumRequest(url='http://www.python.org', always_restart=True))
+
+        mocked_create_driver.assert_called_once_with(
+            'chrome', 'chromedriver', None, None, [])
+        self.assertIs(response.meta['driver'], new_driver)
+        self.assertEqual(middleware.drivers, [new_driver])
+        driver.quit.assert_called_once()
+        driver.execute_cdp_cmd.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_process_request_should_set_the_cookies_before_loading_the_page(self):
+        """Test that the chromium driver sets all the cookies in one call before loading the page"""
+
+        middleware = self.create_middleware()
+        driver = middleware.drivers[0]
+
+        yield defer.ensureDeferred(middleware.process_request(
+            SeleniumRequest(url='http://www.python.org', cookies={'foo': 'bar', 'baz': 'qux'}),
+            None
+        ))
+
+        self.assertEqual(driver.method_calls[:2], [
+            call.execute_cdp_cmd('Network.setCookies', {'cookies': [
+                {'name': 'foo', 'value': 'bar', 'url': 'http://www.python.org'},
+                {'name': 'baz', 'value': 'qux', 'url': 'http://www.python.org'},
+            ]}),
+            call.get('http://www.python.org'),
+        ])
+        driver.add_cookie.assert_not_called()
+
+    def test_scroll_down_to_sentinel_should_carry_the_quiet_period_across_script_calls(self):
+        """Test that a ``timeout`` longer than a script call is spread over several calls"""
+
+        driver = self.create_driver()
+        driver.execute_async_script.side_effect = [[2, False, 15000], [0, False, 35000], [0, True, 40000]]
+
+        SeleniumMiddleware.scroll_down_to_sentinel(driver, '#more', max_scrolls=5, timeout=40)
+
+        self.assertEqual(
+            [call_args[0][1:] for call_args in driver.execute_async_script.call_args_list],
+            [('#more', 5, 40000, 20000, 0), ('#more', 3, 40000, 20000, 15000), ('#more', 3, 40000, 20000, 35000)]
+        )
+
+    @defer.inlineCallbacks
+    def test_spider_closed_should_drop_the_queued_requests(self):
+        """Test that the requests waiting for a driver fail with ``IgnoreRequest`` on close"""
+
+        middleware = self.create_middleware()
+        started, release = threading.Event(), threading.Event()
+        middleware.drivers[0].get.side_effect = lambda url: (started.set(), release.wait(5))
+
+        running = defer.ensureDeferred(middleware.process_request(
+            SeleniumRequest(url='http://www.python.org'), None))
+        queued = defer.ensureDeferred(middleware.process_request(
+            SeleniumRequest(url='http://www.python.org/about'), None))
+        self.assertTrue(started.wait(5))
+
+        # Let the running request finish once the middleware is closing
+        stop_threadpool = middleware.threadpool.stop
+        with patch.object(middleware.threadpool, 'stop',
+                          side_effect=lambda: (release.set(), stop_threadpool())):
+            middleware.spider_closed()
+
+        html_response = yield running
+        self.assertEqual(html_response.url, 'http://www.python.org/')
+        yield self.assertFailure(queued, IgnoreRequest)